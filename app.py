@@ -1,93 +1,278 @@
 import pandas as pd
-import os
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import tempfile
+import sys
+import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
 
+import cache
+import dates
+import discovery
+import duplicates
+import history
+import readers
+import rules
+import schema
+import scheduling
+import workqueue
+
+# Validator of an asyncio worker process, installed once when the process starts so each table
+# is sent without it
+worker_validator = None
+
+
+def install_validator(validator):
+    global worker_validator
+    worker_validator = validator
+
+
+def validate_installed(task):
+    return worker_validator.validate_table(task)
+
+@dataclass
+class TableResult:
+    # Outcome of one table, small enough to send back from a worker process
+    database: str
+    mode: str
+    table_name: str
+    raw_valid: bool = None
+    messages: list = field(default_factory=list)
+    validation_valid: bool = None
+    validation_message: str = None
+    error: str = None
+    duration: float = 0.0
+    log: str = ''
+    schema_updates: dict = field(default_factory=dict)
+
 class DumpFileValidator:
-    def __init__(self):
+    def __init__(self, yyyymmdd='20241204', chunksize=None, reader='pandas', precheck=True, schema_path='schemas.json', project=True,
+                 use_cache=False, workers=1, memory_budget=None, schedule='history', history_path='history.json', prefetch=1,
+                 split_size=None, check_duplicates=True, spill_dir=None):
         # Initialize variables
-        self.window_start = pd.Timestamp('2024-12-02 19:00:00.000000+00:00')
-        self.window_end = pd.Timestamp('2024-12-03 19:00:00.000000+00:00')
-        self.yyyymmdd = '20241204'
+        self.yyyymmdd = yyyymmdd
+        self.window_start, self.window_end = self.window_for(yyyymmdd)
         self.database_names = ['online', 'offline']
         self.environment = ['PRD', 'QA', 'DEV']
         self.etl_mode = {'delta': 'daily', 'full': 'full'}
+        self.etl_mode_labels = {'delta': 'DELTA (DAILY)', 'full': 'FULL'}
+        self.id_columns = ['ID', 'Id', 'DataID', 'ProductOptionDataID']
+        # Checks per mode, declared in rules.py
+        self.rules = {'daily': rules.RuleSet(rules.daily_rules(self.id_columns)),
+                      'full': rules.RuleSet(rules.full_rules(self.id_columns))}
+        # Rows per chunk when streaming raw files, None reads each file whole
+        self.chunksize = chunksize
+        # CSV parsing backend for raw and validation files ('pandas' or 'pyarrow')
+        self.reader = readers.get_reader(reader)
+        # Count raw records before parsing and fail fast on a manifest row_count mismatch
+        self.precheck = precheck
+        # Declared dtypes per database/table_name, learned from earlier successful runs
+        self.schemas = schema.SchemaRegistry(schema_path)
+        # Only parse the raw columns the checks need, the full-row comparison reads its own rows
+        self.project = project
+        # Parsed files are kept as Feather next to the dump for later runs
+        self.cache = cache.ParsedCache(use_cache)
+        # Tables are validated in this many worker processes, and only started while their
+        # estimated memory (memory_factor x file size) fits in memory_budget bytes
+        self.workers = workers
+        self.memory_budget = memory_budget or float('inf')
+        self.memory_factor = 3
+        # Order tables are started in: 'history' (predicted duration), 'size' or 'rows' (longest
+        # first) or 'manifest'
+        self.schedule = schedule
+        # Per-table durations from earlier runs, for the schedule and the ETA
+        self.history = history.RunHistory(history_path)
+        # Upcoming tables parsed ahead when validating without worker processes, see
+        # map_sequential. Files only read into the page cache are read up to prefetch_limit bytes.
+        self.prefetch = prefetch
+        self.prefetch_limit = min(512 * 1024 ** 2, self.memory_budget)
+        # Uncompressed raw files bigger than this many bytes are counted in byte ranges of about
+        # this size by several workers, None keeps one worker per table
+        self.split_size = split_size
+        # Check that ID values don't repeat, keys that don't fit in memory spill to spill_dir (system temp if None)
+        self.check_duplicates = check_duplicates
+        self.spill_dir = spill_dir
+        # Process pool of the asyncio entry points, kept for the validator's lifetime
+        self.async_pool = None
+
+    def __getstate__(self):
+        # Pools don't travel to worker processes
+        state = dict(self.__dict__)
+        state['async_pool'] = None
+        return state
+
+    def process_pool(self):
+        # Process pool of the asyncio entry points, created on first use
+        if self.async_pool is None:
+            self.async_pool = ProcessPoolExecutor(max_workers=self.workers, initializer=install_validator,
+                                                  initargs=(self,))
+        return self.async_pool
+
+    def close(self):
+        if self.async_pool is not None:
+            self.async_pool.shutdown(cancel_futures=True)
+            self.async_pool = None
         
+    def window_for(self, yyyymmdd):
+        # A dump folder covers the 24 hours up to 19:00 UTC on the day before its date
+        window_end = pd.Timestamp(yyyymmdd, tz='UTC') - pd.Timedelta(days=1) + pd.Timedelta(hours=19)
+        return window_end - pd.Timedelta(days=1), window_end
+
+    def for_date(self, yyyymmdd):
+        # Same settings, registries and history, for another day's folder and window
+        if yyyymmdd == self.yyyymmdd:
+            return self
+        day = copy.copy(self)
+        day.yyyymmdd = yyyymmdd
+        day.window_start, day.window_end = self.window_for(yyyymmdd)
+        return day
+
     def check_manifest_headers(self, df):
         required_headers = ['table_name', 'row_count', 'time_start', 'time_end']
         return all(header in df.columns for header in required_headers)
     
-    def check_id_column(self, df):
-        id_columns = ['ID', 'Id', 'DataID', 'ProductOptionDataID']
-        found_cols = [col for col in id_columns if col in df.columns]
-        return len(found_cols) > 0, found_cols[0] if found_cols else None
+    def parse_dates(self, df, date_parser):
+        # Convert date columns to datetime
+        date_columns = ['DateCreated', 'DateModified']
+        for col in date_columns:
+            if col in df.columns:
+                df[col] = date_parser.parse(col, df[col])
+        return df
 
-    def validate_daily_file(self, raw_df, metadata_row):
-        validation_results = []
-        
-        # 4a. Check row count
-        if len(raw_df) != metadata_row['row_count']:
-            validation_results.append(f"Row count mismatch: expected {metadata_row['row_count']}, got {len(raw_df)}")
-        
-        # 4b. Check ID column
-        has_id, id_col = self.check_id_column(raw_df)
-        if not has_id:
-            validation_results.append("No valid ID column found")
-        
-        # 4c. Check IsCreated values
-        if 'IsCreated' in raw_df.columns and 'DateCreated' in raw_df.columns:
-            created_mask = raw_df['DateCreated'] >= self.window_start
-            invalid_created = raw_df[created_mask & (raw_df['IsCreated'] != 1)]
-            if not invalid_created.empty:
-                validation_results.append(f"Found {len(invalid_created)} invalid IsCreated values")
-        
-        # 4d. Check IsModified values
-        if 'IsModified' in raw_df.columns and 'DateModified' in raw_df.columns:
-            modified_mask = raw_df['DateModified'] >= self.window_start
-            invalid_modified = raw_df[modified_mask & (raw_df['IsModified'] != 1)]
-            if not invalid_modified.empty:
-                validation_results.append(f"Found {len(invalid_modified)} invalid IsModified values")
-        
-        # 4e. Check date criteria
-        if 'DateCreated' in raw_df.columns and 'DateModified' in raw_df.columns:
-            date_criteria = (
-                ((raw_df['DateCreated'] >= self.window_start) & 
-                 (raw_df['DateCreated'] < self.window_end)) |
-                ((raw_df['DateModified'] >= self.window_start) & 
-                 (raw_df['DateModified'] < self.window_end))
-            )
-            invalid_dates = raw_df[~date_criteria]
-            if not invalid_dates.empty:
-                validation_results.append(f"Found {len(invalid_dates)} records outside time window")
-        
+    def projection(self, mode, raw_source):
+        # Header order is kept, and at least one column is read so the row count still holds
+        header = readers.read_header(raw_source)
+        needed = self.rules[mode].columns
+        usecols = [col for col in header if col in needed]
+        return usecols or header[:1]
+
+    def read_csv(self, path, database, table_name, date_parser, usecols=None, learn=True, out=None, ahead=None):
+        # Declared dtypes skip inference, a schema that no longer fits is dropped and relearned.
+        # `ahead` is this file as parse_ahead read it, used if it was read with the same dtypes.
+        dtypes = self.schemas.get(database, table_name)
+        df = self.cache.load(str(path), usecols, dtypes)
+        if df is not None:
+            return df
+
+        if ahead is not None and ahead[1] == dtypes and ahead[2] == usecols:
+            df, log = ahead[0], ahead[3]
+            print(log, end='', file=out)
+        else:
+            try:
+                df = self.reader.read(path, dtypes, usecols, out=out)
+            except (ValueError, TypeError) as e:
+                if not dtypes:
+                    raise
+                print(f"Declared schema for {database}/{table_name} does not fit {path}, inferring dtypes: {str(e)}", file=out)
+                self.schemas.forget(database, table_name)
+                dtypes = None
+                df = self.reader.read(path, usecols=usecols, out=out)
+        df = self.parse_dates(df, date_parser)
+        if learn:
+            self.schemas.observe(database, table_name, df, date_parser)
+        self.cache.store(str(path), df, usecols, dtypes, out=out)
+        return df
+
+    def read_chunks(self, path, database, table_name, date_parser, usecols=None, out=None):
+        # Stream the file in bounded chunks. A declared schema that stops fitting part way through
+        # is dropped like in read_csv, and the file is read again with inferred dtypes from the
+        # first row not handed out yet.
+        dtypes = self.schemas.get(database, table_name)
+        chunks, done = None, 0
+        while True:
+            try:
+                if chunks is None:
+                    chunks = iter(self.reader.iter_chunks(path, self.chunksize, dtypes, usecols, out=out))
+                chunk = next(chunks, None)
+            except (ValueError, TypeError) as e:
+                if not dtypes:
+                    raise
+                print(f"Declared schema for {database}/{table_name} does not fit {path}, inferring dtypes: {str(e)}", file=out)
+                self.schemas.forget(database, table_name)
+                dtypes = None
+                chunks = readers.skip_rows(self.reader.iter_chunks(path, self.chunksize, usecols=usecols, out=out), done)
+                continue
+            if chunk is None:
+                return
+            done += len(chunk)
+            chunk = self.parse_dates(chunk, date_parser)
+            self.schemas.observe(database, table_name, chunk, date_parser)
+            yield chunk
+
+    def count_rows(self, raw, count_func):
+        # A DataFrame is counted in one go, anything else is an iterable of chunks
+        if isinstance(raw, pd.DataFrame):
+            return count_func(raw)
+        return self.merge_counts(count_func(chunk) for chunk in raw)
+
+    def merge_counts(self, parts):
+        # Counts of the chunks or byte ranges of one file: numbers add up, the rest is the first part's
+        total = None
+        for counts in parts:
+            if total is None:
+                total = counts
+                continue
+            for key, value in counts.items():
+                if isinstance(value, int):
+                    total[key] += value
+        return total or {'rows': 0, 'id_col': None}
+
+    def precheck_row_count(self, raw_source, metadata_row, out=None):
+        # A partial export fails here without parsing every column. Counting newlines takes a
+        # quote inside a field or a blank line for a record boundary, so a mismatch is only a hint:
+        # it is confirmed by parsing the first column before it is reported.
+        expected = metadata_row['row_count']
+        if readers.count_records(raw_source) == expected:
+            return []
+        header = readers.read_header(raw_source)
+        record_count = 0
+        if header:
+            chunks = self.reader.iter_chunks(raw_source, self.chunksize or 1_000_000, usecols=header[:1], out=out)
+            record_count = sum(len(chunk) for chunk in chunks)
+        if record_count != expected:
+            return [f"Row count mismatch: expected {expected}, got {record_count}"]
+        return []
+
+    def window_bounds(self):
+        return {'window_start': self.window_start, 'window_end': self.window_end}
+
+    def apply_rules(self, mode, raw_df, metadata_row):
+        rule_set, bounds = self.rules[mode], self.window_bounds()
+        keys = duplicates.DuplicateKeys(spill_dir=self.spill_dir) if self.check_duplicates else None
+        try:
+            counts = self.count_rows(raw_df, lambda df: rule_set.count(df, bounds, keys))
+            if keys is not None:
+                counts.update(self.duplicate_counts(keys.finish()))
+        finally:
+            # finish() already removed the spill folder, this only matters when counting raised
+            if keys is not None:
+                keys.discard()
+        return self.check_counts(mode, counts, metadata_row)
+
+    def duplicate_counts(self, found):
+        count, sample = found
+        return {'duplicate_ids': count,
+                'duplicate_ids_sample': f" (e.g. {', '.join(map(str, sample))})" if sample else ''}
+
+    def check_counts(self, mode, counts, metadata_row):
+        validation_results = self.rules[mode].messages(counts, metadata_row['row_count'])
         return len(validation_results) == 0, validation_results
 
+    def validate_daily_file(self, raw_df, metadata_row):
+        # 4a row count, 4b ID column, 4c/4d IsCreated/IsModified since window start, 4e time window
+        return self.apply_rules('daily', raw_df, metadata_row)
+
     def validate_full_file(self, raw_df, metadata_row):
-        validation_results = []
-        
-        # 4a. Check row count
-        if len(raw_df) != metadata_row['row_count']:
-            validation_results.append(f"Row count mismatch: expected {metadata_row['row_count']}, got {len(raw_df)}")
-        
-        # 4b. Check ID column
-        has_id, id_col = self.check_id_column(raw_df)
-        if not has_id:
-            validation_results.append("No valid ID column found")
-        
-        # 4c. Check IsCreated values
-        if 'IsCreated' in raw_df.columns:
-            invalid_created = raw_df[raw_df['IsCreated'] != 1]
-            if not invalid_created.empty:
-                validation_results.append(f"Found {len(invalid_created)} rows with IsCreated != 1")
-        
-        # 4d. Check IsModified values
-        if 'IsModified' in raw_df.columns:
-            invalid_modified = raw_df[raw_df['IsModified'] != 0]
-            if not invalid_modified.empty:
-                validation_results.append(f"Found {len(invalid_modified)} rows with IsModified != 0")
-        
-        return len(validation_results) == 0, validation_results
+        # 4a row count, 4b ID column, 4c IsCreated == 1, 4d IsModified == 0
+        return self.apply_rules('full', raw_df, metadata_row)
 
-    def compare_validation_files(self, raw_df, validation_df):
+    def compare_validation_files(self, raw_df, validation_df, out=None):
         # Check if validation file is empty, meaning no changes
         if len(validation_df.index) == 0:
             return True, "Validation file is empty, no changes made"
@@ -112,111 +297,667 @@ class DumpFileValidator:
         if not (first_row_match or last_row_match):
             # debugging
             if not first_row_match:
-                print("\nFirst row mismatch:")
-                print("Raw file first row:")
-                print(raw_df.iloc[0])
-                print("\nValidation file first row:")
-                print(validation_df.iloc[0])
+                print("\nFirst row mismatch:", file=out)
+                print("Raw file first row:", file=out)
+                print(raw_df.iloc[0], file=out)
+                print("\nValidation file first row:", file=out)
+                print(validation_df.iloc[0], file=out)
             
             if not last_row_match:
-                print("\nLast row mismatch:")
-                print("Raw file last row:")
-                print(raw_df.iloc[-1])
-                print("\nValidation file second row:")
-                print(validation_df.iloc[1])
+                print("\nLast row mismatch:", file=out)
+                print("Raw file last row:", file=out)
+                print(raw_df.iloc[-1], file=out)
+                print("\nValidation file second row:", file=out)
+                print(validation_df.iloc[1], file=out)
 
             if not single_row_match:
-                print("\nSingle row mismatch:")
-                print("Raw file single row:")
-                print(raw_df.iloc[0])
-                print("\nValidation file single row:")
-                print(validation_df.iloc[0])
+                print("\nSingle row mismatch:", file=out)
+                print("Raw file single row:", file=out)
+                print(raw_df.iloc[0], file=out)
+                print("\nValidation file single row:", file=out)
+                print(validation_df.iloc[0], file=out)
             
             return False, "First and/or last rows don't match between raw and validation files"
         
         return True, "Validation file check passed"
 
-    def process_files(self, base_path, etl_mode):
+    def plan_tables(self, manifest_df, index, mode, database):
+        # The whole manifest becomes a typed task table in one go, one row per table. Files are
+        # resolved against the folder index, raw_path/validation_path are empty when missing.
+        prefix = f"{self.yyyymmdd}_jti_vita-ploom-{database}_"
+        table_names = manifest_df['table_name'].astype(str)
+        raw_names = prefix + table_names + '_raw.csv'
+        validation_names = prefix + table_names + '_validation.csv'
+        raw_paths = raw_names.map(index.resolve).fillna('')
+        # A blank or malformed row_count only fails its own table, it comes through as None and
+        # the row count check reports it
+        row_counts = pd.to_numeric(manifest_df['row_count'], errors='coerce')
+        row_counts = row_counts.where(row_counts % 1 == 0).astype('Int64')
+        return pd.DataFrame({
+            'yyyymmdd': self.yyyymmdd,
+            'database': database,
+            'mode': mode,
+            'table_name': table_names,
+            'raw_file': index.folder + '/' + raw_names,
+            'raw_path': raw_paths,
+            'raw_size': raw_paths.map(index.size),
+            'validation_file': index.folder + '/' + validation_names,
+            'validation_path': validation_names.map(index.resolve).fillna(''),
+            'row_count': row_counts,
+            'time_start': pd.to_datetime(manifest_df['time_start'], utc=True, errors='coerce'),
+            'time_end': pd.to_datetime(manifest_df['time_end'], utc=True, errors='coerce'),
+        })
+
+    def validate_table(self, task, parts=None, keys=None, ahead=None):
+        # Read, check and compare one table. What it prints goes into the result's log, so tables
+        # validated in worker processes or threads are still printed in manifest order and
+        # sys.stdout is never touched.
+        result = TableResult(task['database'], task['mode'], task['table_name'])
+        log = io.StringIO()
+        started = time.perf_counter()
+        self.for_date(task['yyyymmdd']).check_table(task, result, log, parts, keys, ahead)
+        result.duration = time.perf_counter() - started
+        result.log = log.getvalue()
+        result.schema_updates = self.schemas.drain()
+        return result
+
+    def check_table(self, row, result, out=None, parts=None, keys=None, ahead=None):
+        database, mode, table_name = row['database'], row['mode'], row['table_name']
+        print(f"\nValidating table: {table_name} - {database}", file=out)
+        
+        # Process raw file
+        raw_file = row['raw_path']
+        if not raw_file:
+            result.error = f"Raw file not found: {row['raw_file']}"
+            print(result.error, file=out)
+            return
+        
+        # Read CSV with date parsing, timestamp formats are detected once per table
+        date_parser = dates.DateParser()
+        try:
+            # The raw file is mapped once for the precheck, the parse and the edge rows
+            with readers.DumpSource(raw_file) as raw_source:
+                messages = self.precheck_row_count(raw_source, row, out) if self.precheck and parts is None else []
+                if messages:
+                    is_valid = False
+                elif parts is not None:
+                    # Already parsed and counted range by range in worker processes, see submit_table.
+                    # The counts cover the whole file, so the precheck would only repeat the row count.
+                    # The key folder is merged and removed first, also when a range failed
+                    found = self.duplicate_counts(duplicates.merge(keys)) if keys else {}
+                    counts = self.merge_parts(parts, row, out)
+                    counts.update(found)
+                    is_valid, messages = self.check_counts(mode, counts, row)
+                else:
+                    usecols = self.projection(mode, raw_source) if self.project else None
+                    if self.chunksize:
+                        raw_data = self.read_chunks(raw_source, database, table_name, date_parser, usecols, out=out)
+                    else:
+                        raw_data = self.read_csv(raw_source, database, table_name, date_parser, usecols, out=out,
+                                                 ahead=(ahead or {}).get('raw'))
+                    
+                    # Validate based on etlmode
+                    if mode == 'daily':
+                        is_valid, messages = self.validate_daily_file(raw_data, row)
+                    else:
+                        is_valid, messages = self.validate_full_file(raw_data, row)
+                    if is_valid:
+                        self.schemas.commit(database, table_name)
+                result.raw_valid, result.messages = is_valid, messages
+                
+                print(f"Raw file validation: {'PASSED' if is_valid else 'FAILED'}", file=out)
+                if not is_valid:
+                    for msg in messages:
+                        print(f"- {msg}", file=out)
+                
+                # Check validation file
+                validation_file = row['validation_path']
+                if validation_file:
+                    try:
+                        # Read validation file with the same date parsing as raw file
+                        validation_df = self.read_csv(validation_file, database, table_name, date_parser, learn=False,
+                                                      out=out, ahead=(ahead or {}).get('validation'))
+                                
+                        # Only the header, first and last raw rows are needed, read them straight from disk
+                        dtypes = self.schemas.get(database, table_name)
+                        raw_df = self.parse_dates(readers.read_edge_rows(raw_source, self.reader, dtypes), date_parser)
+                        is_valid, message = self.compare_validation_files(raw_df, validation_df, out)
+                        result.validation_valid, result.validation_message = is_valid, message
+                        print(f"Validation file check: {message}", file=out)
+                    except Exception as e:
+                        result.validation_message = f"Error processing validation file: {str(e)}"
+                        print(result.validation_message, file=out)
+                else:
+                    result.validation_message = f"Validation file not found: {row['validation_file']}"
+                    print(result.validation_message, file=out)
+                
+        except Exception as e:
+            result.error = f"Error processing {table_name}: {str(e)}"
+            print(result.error, file=out)
+
+    def failed_table(self, task, error):
+        # Result of a table whose worker failed outside check_table, e.g. a worker process that was
+        # killed (BrokenProcessPool), printed like check_table prints its own errors
+        result = TableResult(task['database'], task['mode'], task['table_name'])
+        result.error = f"Error processing {task['table_name']}: {str(error) or type(error).__name__}"
+        result.log = f"\nValidating table: {task['table_name']} - {task['database']}\n{result.error}\n"
+        return result
+
+    def outcome(self, task, future):
+        try:
+            return future.result()
+        except Exception as e:
+            return self.failed_table(task, e)
+
+    def estimate_memory(self, task):
+        # Rough peak memory of one table, from its size on disk. Compressed dumps expand a lot.
+        # A split table has up to one range per worker in flight.
+        factor = self.memory_factor * (5 if readers.compression_of(task['raw_path']) else 1)
+        if self.splits(task):
+            return min(task['raw_size'], self.workers * self.split_size) * factor
+        return task['raw_size'] * factor
+
+    def splits(self, task):
+        return bool(self.split_size and task['raw_path'] and task['raw_size'] > self.split_size
+                    and not readers.compression_of(task['raw_path']))
+
+    def split_table(self, task):
+        with readers.DumpSource(task['raw_path']) as source:
+            return readers.split_records(source, self.split_size)
+
+    def count_range(self, task, header_end, start, end, keys=None):
+        # Rule counts of the records in one byte range of a raw file, run in a worker process.
+        # Ranges are bounded by split_size so they are read whole. Schema learning and the parsed
+        # cache work on whole files and are skipped, but a declared schema that doesn't fit is
+        # reported back so the table forgets it. ID keys are spilled to the table's shared folder.
+        day = self.for_date(task['yyyymmdd'])
+        database, table_name = task['database'], task['table_name']
+        log = io.StringIO()
+        with readers.RangeSource(task['raw_path'], header_end, start, end) as source:
+            usecols = self.projection(task['mode'], source) if self.project else None
+            dtypes = self.schemas.get(database, table_name)
+            misfit = None
+            try:
+                df = self.reader.read(source, dtypes, usecols, out=log)
+            except (ValueError, TypeError) as e:
+                if not dtypes:
+                    raise
+                misfit = str(e)
+                df = self.reader.read(source, usecols=usecols, out=log)
+            df = self.parse_dates(df, dates.DateParser())
+            range_keys = duplicates.DuplicateKeys(keys, name=str(start)) if keys else None
+            counts = self.rules[task['mode']].count(df, day.window_bounds(), range_keys)
+            if range_keys is not None:
+                range_keys.spill()
+        return counts, log.getvalue(), misfit
+
+    def merge_parts(self, parts, row, out=None):
+        # (counts, log, schema misfit) per range, or the exception a range or the split failed with
+        for part in parts:
+            if isinstance(part, BaseException):
+                raise part
+            print(part[1], end='', file=out)
+        misfit = next((misfit for counts, log, misfit in parts if misfit), None)
+        if misfit:
+            database, table_name = row['database'], row['table_name']
+            print(f"Declared schema for {database}/{table_name} does not fit {row['raw_path']}, inferring dtypes: {misfit}",
+                  file=out)
+            self.schemas.forget(database, table_name)
+        return self.merge_counts(counts for counts, log, misfit in parts)
+
+    def submit_table(self, pool, task):
+        # A big uncompressed raw file is cut into record-aligned byte ranges that are parsed and
+        # counted by several workers, then the table is finished from the merged counts. Every
+        # stage is submitted from callbacks in this process, workers never start a pool of their own.
+        if not self.splits(task):
+            return self.submit(pool, self.validate_table, task)
+        table = Future()
+        lock = threading.Lock()
+        keys = tempfile.mkdtemp(prefix='dump-keys-', dir=self.spill_dir) if self.check_duplicates else None
+        started = time.perf_counter()
+
+        def done(final):
+            # The final check merges and removes the key folder, unless it failed before that
+            if keys:
+                duplicates.discard(keys)
+            if final.exception():
+                table.set_exception(final.exception())
+                return
+            # The table took from the split to the final check, not just the final check, or the
+            # history would predict the biggest tables as nearly free
+            result = final.result()
+            result.duration = time.perf_counter() - started
+            table.set_result(result)
+
+        def finish(parts):
+            self.submit(pool, self.validate_table, task, parts, keys).add_done_callback(done)
+
+        def counted(futures):
+            with lock:
+                if table.running() or not all(f.done() for f in futures):
+                    return
+                table.set_running_or_notify_cancel()
+            finish([f.exception() or f.result() for f in futures])
+
+        def split(f):
+            if f.exception():
+                table.set_running_or_notify_cancel()
+                finish([f.exception()])
+                return
+            header_end, ranges = f.result()
+            futures = [self.submit(pool, self.count_range, task, header_end, start, end, keys) for start, end in ranges]
+            if not futures:
+                table.set_running_or_notify_cancel()
+                finish([])
+            for part in futures:
+                part.add_done_callback(lambda _: counted(futures))
+
+        self.submit(pool, self.split_table, task).add_done_callback(split)
+        return table
+
+    def submit(self, pool, fn, *args):
+        # A broken pool refuses new work, which then fails like the work itself would have
+        try:
+            return pool.submit(fn, *args)
+        except BrokenExecutor as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+
+    def finished(self, progress, tasks, i, result):
+        self.history.record(tasks[i], result.duration)
+        progress.done(i, result.duration)
+
+    def map_tables(self, pool, tasks):
+        # Results are yielded in task order whether tables run here or in worker processes
+        progress = scheduling.Progress(tasks, self.history, self.workers if pool else 1)
+        if pool is None:
+            yield from self.map_sequential(progress, tasks)
+            return
+
+        # A worker process that dies (killed for memory, say) breaks the whole pool and every table
+        # in flight on it. The pool is replaced and those tables run once more, each on its own so
+        # the one that killed it can't take the others down again; a table that fails again, or
+        # fails any other way, gets an error result and the rest of the run goes on.
+        queue = scheduling.submission_order(tasks, self.schedule, self.history)
+        futures, running, results, owners, retried, spares = {}, {}, {}, {}, set(), []
+        try:
+            for i in range(len(tasks)):
+                while i not in results:
+                    # Submit queued tasks while worker slots and the memory budget allow. When the next
+                    # big table doesn't fit, smaller ones further down the queue fill the gap, and a
+                    # task bigger than the whole budget still runs, just on its own.
+                    while queue and len(running) < self.workers:
+                        used, alone = sum(running.values()), running.keys() & retried
+                        j = next((j for j in queue
+                                  if not running or (not alone and j not in retried
+                                                     and used + self.estimate_memory(tasks[j]) <= self.memory_budget)), None)
+                        if j is None:
+                            break
+                        queue.remove(j)
+                        futures[j], owners[j] = self.submit_table(pool, tasks[j]), pool
+                        running[j] = self.estimate_memory(tasks[j])
+                    wait([futures[j] for j in running], return_when=FIRST_COMPLETED)
+                    for j in [j for j in running if futures[j].done()]:
+                        del running[j]
+                        future, owner = futures.pop(j), owners.pop(j)
+                        if isinstance(future.exception(), BrokenExecutor) and j not in retried:
+                            retried.add(j)
+                            if owner is pool:
+                                pool = ProcessPoolExecutor(max_workers=self.workers)
+                                spares.append(pool)
+                            queue.insert(0, j)
+                            continue
+                        results[j] = self.outcome(tasks[j], future)
+                        self.finished(progress, tasks, j, results[j])
+                yield results.pop(i)
+        finally:
+            for spare in spares:
+                spare.shutdown(cancel_futures=True)
+
+    def read_ahead(self, task, stop):
+        for path in (task['raw_path'], task['validation_path']):
+            if path and not stop.is_set():
+                readers.read_ahead(path, stop, self.prefetch_limit)
+
+    def parse_ahead(self, task, stop):
+        # The raw and validation files of an upcoming table, read on an I/O thread the way
+        # check_table would read them, as {'raw'/'validation': (frame, dtypes, usecols, log)}.
+        # pyarrow and pandas' tokenizer parse without the GIL. Dates, schema learning and the
+        # checks stay with the table; a file that fails to parse is left for read_csv to report.
+        frames = {}
+        dtypes = self.schemas.get(task['database'], task['table_name'])
+        for name, path in (('raw', task['raw_path']), ('validation', task['validation_path'])):
+            if not path or stop.is_set():
+                continue
+            log = io.StringIO()
+            try:
+                if name == 'raw':
+                    with readers.DumpSource(path) as source:
+                        usecols = self.projection(task['mode'], source) if self.project else None
+                        df = self.reader.read(source, dtypes, usecols, out=log)
+                else:
+                    usecols = None
+                    df = self.reader.read(path, dtypes, out=log)
+            except Exception:
+                continue
+            frames[name] = (df, dtypes, usecols, log.getvalue())
+        return frames
+
+    def map_sequential(self, progress, tasks):
+        # While one table is checked, the next `prefetch` tables are parsed on I/O threads, so the
+        # disk and the parser work while the checks run here. Parsed tables are held while their
+        # estimated memory fits the memory budget next to the table being checked. Streamed
+        # (--chunksize) and cached runs parse nothing ahead, there the files are only read into
+        # the page cache, up to prefetch_limit bytes each. A table whose turn comes first is read
+        # here: a read-ahead that didn't start is dropped, page cache reading stops.
+        parse = not self.chunksize and not self.cache.enabled
+        ahead = {}
+        io_pool = ThreadPoolExecutor(max_workers=self.prefetch) if self.prefetch else None
+        try:
+            for i, task in enumerate(tasks):
+                future, stop = ahead.pop(i, (None, None))
+                frames = None
+                if future is not None:
+                    stop.set()
+                    if parse and not future.cancel():
+                        frames = future.result()
+                held = self.estimate_memory(task) + sum(self.estimate_memory(tasks[j]) for j in ahead)
+                for j in range(i + 1, min(i + 1 + self.prefetch, len(tasks))):
+                    if j in ahead or (parse and held + self.estimate_memory(tasks[j]) > self.memory_budget):
+                        continue
+                    stop = threading.Event()
+                    ahead[j] = (io_pool.submit(self.parse_ahead if parse else self.read_ahead, tasks[j], stop), stop)
+                    held += self.estimate_memory(tasks[j])
+                result = self.validate_table(task, ahead=frames)
+                # Not held while the caller reports
+                frames = None
+                self.finished(progress, tasks, i, result)
+                yield result
+        finally:
+            for future, stop in ahead.values():
+                stop.set()
+            if io_pool:
+                io_pool.shutdown(cancel_futures=True)
+
+    def report(self, result):
+        print(result.log, end='')
+        self.schemas.apply(result.schema_updates)
+
+    def plan_mode(self, base_path, etl_mode):
+        # Everything one etl mode prints, in order: text lines, and a task dict wherever a
+        # table's result goes
         mode = self.etl_mode[etl_mode]
+        # One listing of the folder resolves every manifest and dump file
+        index = discovery.DumpIndex(f"{base_path}/{mode}")
+        plan = []
         
         for database in self.database_names:
-            print(f"\n========== PROCESSING {database} DATABASE ==========")
+            plan.append(f"\n========== PROCESSING {database} DATABASE ==========")
             
             # Read manifest file
-            manifest_path = f"{base_path}/{mode}/{self.yyyymmdd}_jti_vita-ploom-{database}_Manifest.csv"
-            if not os.path.exists(manifest_path):
-                print(f"Manifest file not found: {manifest_path}")
+            manifest_name = f"{self.yyyymmdd}_jti_vita-ploom-{database}_Manifest.csv"
+            manifest_path = index.resolve(manifest_name)
+            if manifest_path is None:
+                plan.append(f"Manifest file not found: {index.path(manifest_name)}")
                 continue
             
             manifest_df = pd.read_csv(manifest_path)
             if not self.check_manifest_headers(manifest_df):
-                print(f"Invalid manifest headers for {database}")
+                plan.append(f"Invalid manifest headers for {database}")
                 continue
             
-            # Process each table
-            for _, row in manifest_df.iterrows():
-                table_name = row['table_name']
-                print(f"\nValidating table: {table_name} - {database}")
-                
-                # Process raw file
-                raw_file = f"{base_path}/{mode}/{self.yyyymmdd}_jti_vita-ploom-{database}_{table_name}_raw.csv"
-                if not os.path.exists(raw_file):
-                    print(f"Raw file not found: {raw_file}")
-                    continue
-                
-                # Read CSV with date parsing
-                try:
-                    raw_df = pd.read_csv(raw_file)
-                    # Convert date columns to datetime
-                    date_columns = ['DateCreated', 'DateModified']
-                    for col in date_columns:
-                        if col in raw_df.columns:
-                            raw_df[col] = pd.to_datetime(raw_df[col], utc=True)
-                    
-                    # Validate based on etlmode
-                    if mode == 'daily':
-                        is_valid, messages = self.validate_daily_file(raw_df, row)
-                    else:
-                        is_valid, messages = self.validate_full_file(raw_df, row)
-                    
-                    print(f"Raw file validation: {'PASSED' if is_valid else 'FAILED'}")
-                    if not is_valid:
-                        for msg in messages:
-                            print(f"- {msg}")
-                    
-                    # Check validation file
-                    validation_file = f"{base_path}/{mode}/{self.yyyymmdd}_jti_vita-ploom-{database}_{table_name}_validation.csv"
-                    if os.path.exists(validation_file):
-                        try:
-                            # Read validation file with the same date parsing as raw file
-                            validation_df = pd.read_csv(validation_file)
-                            date_columns = ['DateCreated', 'DateModified']
-                            for col in date_columns:
-                                if col in validation_df.columns:
-                                    validation_df[col] = pd.to_datetime(validation_df[col], utc=True)
-                                    
-                            is_valid, message = self.compare_validation_files(raw_df, validation_df)
-                            print(f"Validation file check: {message}")
-                        except Exception as e:
-                            print(f"Error processing validation file: {str(e)}")
-                    else:
-                        print(f"Validation file not found: {validation_file}")
-                        
-                except Exception as e:
-                    print(f"Error processing {table_name}: {str(e)}")
-                    continue
+            try:
+                tasks = self.plan_tables(manifest_df, index, mode, database)
+            except ValueError as e:
+                plan.append(f"Invalid manifest for {database}: {str(e)}")
+                continue
+            plan.extend(tasks.to_dict('records'))
+        
+        orphans = index.orphans()
+        if orphans:
+            plan.append(f"\nFiles in {index.folder} not listed in any manifest:")
+            plan.extend(f"- {name}" for name in orphans)
+        return plan
+
+    def execute(self, plan):
+        # Every table in the plan shares one pool, so the worker and memory budgets are global
+        tasks = [item for item in plan if isinstance(item, dict)]
+        pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        with pool or contextlib.nullcontext():
+            results = self.map_tables(pool, tasks)
+            for item in plan:
+                if isinstance(item, dict):
+                    self.report(next(results))
+                else:
+                    print(item)
+        self.schemas.save()
+        self.history.save()
+
+    def process_files(self, base_path, etl_mode):
+        self.execute(self.plan_mode(base_path, etl_mode))
+
+    async def aexecute(self, plan, executor=None):
+        # execute() for an event loop: tables are validated in an executor and awaited together.
+        # Any executor can be passed in. By default tables run on the loop's thread pool, or with
+        # workers > 1 in a process pool that is created once, holds the validator in every process
+        # and is reused by later calls until close(). The memory budget is left to the executor's
+        # size. Returns the table results in plan order. A worker process of the validator's own
+        # pool that dies takes every table in flight with it; like in map_tables they run once
+        # more, one at a time on a fresh pool.
+        tasks = [item for item in plan if isinstance(item, dict)]
+        loop = asyncio.get_running_loop()
+        progress = scheduling.Progress(tasks, self.history, self.workers)
+        own_pool = executor is None and self.workers > 1
+        validate_task = validate_installed if own_pool else self.validate_table
+
+        async def validate(i, retry=False):
+            pool = self.process_pool() if own_pool else executor
+            try:
+                result = await loop.run_in_executor(pool, validate_task, tasks[i])
+            except BrokenExecutor as e:
+                if own_pool and pool is self.async_pool:
+                    # The next table gets a fresh pool, the broken one has already failed all its work
+                    self.async_pool = None
+                    pool.shutdown(wait=False)
+                if own_pool and not retry:
+                    return i, None
+                result = self.failed_table(tasks[i], e)
+            except Exception as e:
+                result = self.failed_table(tasks[i], e)
+            self.finished(progress, tasks, i, result)
+            return i, result
+
+        # Submitted longest first, like the local pool
+        done = await asyncio.gather(*(validate(i) for i in
+                                      scheduling.submission_order(tasks, self.schedule, self.history)))
+        for n, (i, result) in enumerate(done):
+            if result is None:
+                done[n] = await validate(i, retry=True)
+        results = [result for i, result in sorted(done, key=lambda pair: pair[0])]
+
+        ordered = iter(results)
+        for item in plan:
+            if isinstance(item, dict):
+                self.report(next(ordered))
+            else:
+                print(item)
+        await asyncio.to_thread(self.schemas.save)
+        await asyncio.to_thread(self.history.save)
+        return results
+
+    async def aprocess_files(self, base_path, etl_mode, executor=None):
+        # Folder listing, stat calls and manifest reads run on a thread, so the event loop is never blocked
+        plan = await asyncio.to_thread(self.plan_mode, base_path, etl_mode)
+        return await self.aexecute(plan, executor)
+
+    async def arun(self, base_path, etl_modes=('delta', 'full'), executor=None):
+        plan = await asyncio.to_thread(self.plan_run, base_path, etl_modes)
+        return await self.aexecute(plan, executor)
+
+    def plan_run(self, base_path, etl_modes):
+        plan = []
+        for etl_mode in etl_modes:
+            plan.append(f"\n********** PROCESSING {self.etl_mode_labels[etl_mode]} FILES **********")
+            plan.extend(self.plan_mode(base_path, etl_mode))
+        return plan
+
+    def run(self, base_path, etl_modes=('delta', 'full')):
+        # Both databases and every etl mode planned up front and run as one task graph, so the
+        # run takes about as long as its longest table instead of the sum of all passes
+        self.execute(self.plan_run(base_path, etl_modes))
+
+    def backfill(self, root, start, end, etl_modes=('delta', 'full')):
+        # Every day from start to end (inclusive) in one plan and one worker pool, so tables from
+        # different days are scheduled together. Each day gets its own {root}/yyyymmdd folder and
+        # window.
+        self.execute(self.plan_backfill(root, start, end, etl_modes))
+
+    def plan_backfill(self, root, start, end, etl_modes):
+        plan = []
+        for day in pd.date_range(pd.Timestamp(start), pd.Timestamp(end), freq='D').strftime('%Y%m%d'):
+            plan.append(f"\n################ {day} ################")
+            plan.extend(self.for_date(day).plan_run(f"{root}/{day}", etl_modes))
+        return plan
+
+    def enqueue(self, queue, plan):
+        # Workers claim tasks longest first, same as the local pool
+        tasks = [item for item in plan if isinstance(item, dict)]
+        ranks = [0] * len(tasks)
+        for rank, i in enumerate(scheduling.submission_order(tasks, self.schedule, self.history)):
+            ranks[i] = rank
+        return queue.enqueue(plan, ranks)
+
+    def work(self, queue, poll=5):
+        # Claim and validate tables until the queue is done. While other workers still hold
+        # leases keep polling, so tasks of a worker that died are picked up once their lease expires.
+        # Workers may start before the coordinator, they wait for its plan.
+        owner = workqueue.worker_name()
+        while True:
+            claimed = queue.claim(owner)
+            if claimed is None:
+                if queue.planned() and not queue.pending():
+                    return
+                time.sleep(poll)
+                continue
+            seq, task = claimed
+            beat = queue.heartbeat(seq, owner)
+            try:
+                result = self.validate_table(task)
+            finally:
+                beat.set()
+            queue.complete(seq, asdict(result))
+
+    def serve(self, queue):
+        # One work loop per local worker process
+        if self.workers <= 1:
+            self.work(queue)
+            return
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(self.work, queue) for _ in range(self.workers)]:
+                future.result()
+
+    def merge(self, queue, poll=10):
+        # Wait for the workers, then print the whole plan in order like a local run
+        left = queue.pending()
+        while left:
+            print(f"[waiting for {left} tables in {queue.path}]", file=sys.stderr, flush=True)
+            time.sleep(poll)
+            left = queue.pending()
+        for line, task, result in queue.entries():
+            if task is None:
+                print(line)
+                continue
+            result = TableResult(**result)
+            self.history.record(task, result.duration)
+            self.report(result)
+        self.schemas.save()
+        self.history.save()
 
 def main():
-    validator = DumpFileValidator()
-    base_path = "./20241204"
+    parser = argparse.ArgumentParser(description="Validate VITA daily/full dumps")
+    parser.add_argument('--root', default='.',
+                        help="folder holding the yyyymmdd dump folders")
+    parser.add_argument('--date', default='20241204',
+                        help="dump folder to validate (yyyymmdd)")
+    parser.add_argument('--from', dest='start', default=None,
+                        help="backfill every dump folder from this date (yyyymmdd) ...")
+    parser.add_argument('--to', dest='end', default=None,
+                        help="... up to and including this date, defaults to --from")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="stream raw files in chunks of this many rows instead of reading them whole")
+    parser.add_argument('--reader', choices=sorted(readers.READERS), default='pandas',
+                        help="CSV parsing backend, pyarrow parses on all cores")
+    parser.add_argument('--no-precheck', dest='precheck', action='store_false',
+                        help="skip the row count precheck and always parse raw files")
+    parser.add_argument('--schemas', default='schemas.json',
+                        help="per-table dtype registry, learned from successful runs and editable by hand ('' disables it)")
+    parser.add_argument('--no-project', dest='project', action='store_false',
+                        help="parse every raw column instead of only the ones the checks use")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep parsed files as Feather next to the dumps and reuse them on later runs")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="validate tables in this many worker processes, shared by every database and etl mode")
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help="GB of estimated table memory allowed in flight across all workers")
+    parser.add_argument('--schedule', choices=['history', 'size', 'rows', 'manifest'], default='history',
+                        help="start tables by predicted duration, file size or manifest row_count (longest first), "
+                             "or in manifest order")
+    parser.add_argument('--history', default='history.json',
+                        help="per-table run durations used for scheduling and the ETA ('' disables it)")
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help="without --workers, parse the files of this many upcoming tables ahead while one is checked, "
+                             "within the memory budget (0 disables it)")
+    parser.add_argument('--split-size', type=int, default=None,
+                        help="with --workers, count uncompressed raw files bigger than this many MB in byte ranges "
+                             "of about this size on several workers")
+    parser.add_argument('--no-duplicates', dest='check_duplicates', action='store_false',
+                        help="skip the duplicate ID check")
+    parser.add_argument('--spill-dir', default=None,
+                        help="folder for ID keys that don't fit in memory during the duplicate check (system temp by default)")
+    parser.add_argument('--queue', default=None,
+                        help="SQLite work queue on shared storage for validating with workers on several hosts")
+    parser.add_argument('--role', choices=['coordinator', 'worker'], default='coordinator',
+                        help="with --queue: enqueue the plan and print the merged report, or claim and validate tables")
+    parser.add_argument('--lease', type=int, default=900,
+                        help="seconds before a claimed table of a silent worker is handed to another one")
+    args = parser.parse_args()
+    if args.start:
+        args.end = args.end or args.start
+        try:
+            start, end = pd.Timestamp(args.start), pd.Timestamp(args.end)
+        except ValueError as e:
+            parser.error(f"invalid --from/--to date: {str(e)}")
+        if start > end:
+            parser.error(f"--from {args.start} is after --to {args.end}")
+
+    validator = DumpFileValidator(yyyymmdd=args.date, chunksize=args.chunksize, reader=args.reader, precheck=args.precheck,
+                                  schema_path=args.schemas, project=args.project, use_cache=args.cache,
+                                  workers=args.workers,
+                                  memory_budget=args.memory_budget and int(args.memory_budget * 1024 ** 3),
+                                  schedule=args.schedule, history_path=args.history, prefetch=args.prefetch,
+                                  split_size=args.split_size and args.split_size * 1024 ** 2,
+                                  check_duplicates=args.check_duplicates, spill_dir=args.spill_dir)
     
-    # Process delta (daily) files
-    print("\n********** PROCESSING DELTA (DAILY) FILES **********")
-    validator.process_files(base_path, 'delta')
+    # Process delta (daily) and full files, for one day or a backfilled range of days
+    if args.queue and args.role == 'worker':
+        plan = []
+    elif args.start:
+        plan = validator.plan_backfill(args.root, args.start, args.end, ['delta', 'full'])
+    else:
+        plan = validator.plan_run(f"{args.root}/{args.date}", ['delta', 'full'])
     
-    # Process full files
-    print("\n********** PROCESSING FULL FILES **********")
-    validator.process_files(base_path, 'full')
+    if not args.queue:
+        validator.execute(plan)
+        return
+    # Dump paths are stored as the coordinator sees them, workers must mount the share at the same path
+    queue = workqueue.WorkQueue(args.queue, lease=args.lease)
+    if args.role == 'worker':
+        validator.serve(queue)
+    else:
+        if not validator.enqueue(queue, plan):
+            print(f"[{args.queue} already holds a plan, resuming it]", file=sys.stderr, flush=True)
+        validator.merge(queue)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
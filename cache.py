@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = feather = None
+
+SUFFIX = '.parsed.feather'
+HASH_SAMPLE = 1024 * 1024
+
+
+def fingerprint(path):
+    # Size and mtime plus a hash of the first and last MB of the file. Hashing all of it would
+    # cost as much I/O as parsing it again.
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(HASH_SAMPLE))
+        if stat.st_size > HASH_SAMPLE:
+            f.seek(max(HASH_SAMPLE, stat.st_size - HASH_SAMPLE))
+            digest.update(f.read())
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+            'hash': digest.hexdigest()}
+
+
+class ParsedCache:
+    # Parsed raw/validation files stored as Feather next to the dump, so re-runs on the same
+    # day load them with a memory-mapped columnar read instead of parsing the CSV again
+    def __init__(self, enabled=False):
+        if enabled and feather is None:
+            print("pyarrow is not installed, the parsed file cache is disabled")
+        self.enabled = enabled and feather is not None
+
+    def key(self, path, usecols, dtypes):
+        return dict(fingerprint(path), usecols=usecols, dtypes=dtypes)
+
+    def load(self, path, usecols=None, dtypes=None):
+        sidecar = path + SUFFIX
+        if not self.enabled or not os.path.exists(sidecar):
+            return None
+        try:
+            table = feather.read_table(sidecar, memory_map=True)
+            stored = json.loads(table.schema.metadata[b'dump_cache'])
+        except (OSError, KeyError, ValueError, pa.ArrowException):
+            return None
+        if stored != self.key(path, usecols, dtypes):
+            return None
+        return table.to_pandas(split_blocks=True)
+
+    def store(self, path, df, usecols=None, dtypes=None, out=None):
+        if not self.enabled:
+            return
+        sidecar = path + SUFFIX
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            metadata = dict(table.schema.metadata or {})
+            metadata[b'dump_cache'] = json.dumps(self.key(path, usecols, dtypes)).encode()
+            # Written aside and moved into place so a crashed run never leaves half a cache file
+            feather.write_feather(table.replace_schema_metadata(metadata), sidecar + '.tmp')
+            os.replace(sidecar + '.tmp', sidecar)
+        except (OSError, ValueError, pa.ArrowException) as e:
+            print(f"Could not cache {path}: {str(e)}", file=out)
@@ -0,0 +1,52 @@
+import pandas as pd
+
+# Timestamp layouts seen in the dumps, tried in order against a sample of each date column
+FORMATS = [
+    '%Y-%m-%d %H:%M:%S.%f%z',
+    '%Y-%m-%d %H:%M:%S%z',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f%z',
+    '%Y-%m-%dT%H:%M:%S%z',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    'ISO8601',
+]
+SAMPLE_SIZE = 1000
+
+
+class DateParser:
+    # One per table, so each column's format is detected once and reused for every chunk
+    # and for the validation file
+    def __init__(self):
+        self.formats = {}
+
+    def detect_format(self, values):
+        sample = values.dropna().head(SAMPLE_SIZE)
+        if sample.empty:
+            return None
+        for fmt in FORMATS:
+            try:
+                pd.to_datetime(sample, format=fmt, utc=True)
+            except (ValueError, TypeError):
+                continue
+            return fmt
+        return None
+
+    def parse(self, col, values):
+        # Already parsed by the reader (pyarrow), only the timezone needs settling
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return pd.to_datetime(values, utc=True)
+
+        if self.formats.get(col) is None:
+            self.formats[col] = self.detect_format(values)
+
+        # Dumps repeat the same timestamps a lot, parse each distinct value once
+        codes, uniques = pd.factorize(values)
+        try:
+            parsed = pd.to_datetime(uniques, format=self.formats[col], utc=True)
+        except (ValueError, TypeError):
+            # Format changed part way through the table, fall back to inference
+            self.formats[col] = None
+            parsed = pd.to_datetime(uniques, utc=True)
+        return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=values.index, name=values.name)
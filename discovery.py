@@ -0,0 +1,42 @@
+import os
+
+import readers
+
+# Files we write next to the dumps ourselves
+OWN_SUFFIXES = ('.parsed.feather', '.tmp')
+
+
+class DumpIndex:
+    # One os.scandir of a {base_path}/{mode} folder. Manifest entries are resolved from memory
+    # instead of an os.path.exists per file, which is a round-trip each on network mounts.
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = {}
+        self.claimed = set()
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_file():
+                        self.entries[entry.name] = entry
+        except FileNotFoundError:
+            pass
+
+    def path(self, name):
+        return f"{self.folder}/{name}"
+
+    def resolve(self, name):
+        # Plain, .gz or .zst variant of a file name, None if the folder has none of them
+        for suffix in readers.COMPRESSIONS:
+            if name + suffix in self.entries:
+                self.claimed.add(name + suffix)
+                return self.path(name + suffix)
+        return None
+
+    def size(self, path):
+        # On-disk size straight from the scan (free on Windows, one stat elsewhere), 0 if unknown
+        entry = self.entries.get(os.path.basename(path)) if path else None
+        return entry.stat().st_size if entry else 0
+
+    def orphans(self):
+        return sorted(name for name in self.entries
+                      if name not in self.claimed and not name.endswith(OWN_SUFFIXES))
@@ -0,0 +1,203 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+PARTITION_BITS = 6
+PARTITIONS = 1 << PARTITION_BITS
+# Keys held in memory before they are spilled to partition files
+MEMORY_LIMIT = 512 * 1024 * 1024
+SAMPLE_SIZE = 10
+# Fibonacci hashing spreads sequential IDs evenly over the partitions
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+# IDs behind hashed keys are spilled next to them as NUL separated UTF-8
+SEPARATOR = '\0'
+# Rough memory of one ID kept as a Python string
+TEXT_SIZE = 64
+
+
+def as_text(keys):
+    return keys.astype(str).astype(object)
+
+
+def hash_keys(texts):
+    # pandas' 64-bit hash of ID texts, an integer key hashes like the same ID read as text
+    return pd.util.hash_array(texts).view(np.int64)
+
+
+def int64_keys(values):
+    # ID values as int64 keys, and the ID texts behind them when they had to be hashed (None when
+    # the keys are the IDs). Integer IDs, also when read as float because some are missing, are
+    # used as they are; anything else, and unsigned IDs past the int64 range, goes through pandas'
+    # 64-bit hash. Missing IDs are left out, they don't collide with anything.
+    values = values.dropna()
+    if pd.api.types.is_integer_dtype(values):
+        if not (pd.api.types.is_unsigned_integer_dtype(values) and len(values) and values.max() >= 2 ** 63):
+            return values.to_numpy().astype(np.int64, copy=False), None
+    elif pd.api.types.is_float_dtype(values):
+        floats = values.to_numpy()
+        if np.all(floats == np.floor(floats)) and np.all(np.abs(floats) < 2 ** 63):
+            return floats.astype(np.int64), None
+    texts = values.astype(str).to_numpy(dtype=object)
+    return hash_keys(texts), texts
+
+
+def partition_of(keys):
+    return ((keys.view(np.uint64) * GOLDEN) >> np.uint64(64 - PARTITION_BITS)).astype(np.intp)
+
+
+def write_partitions(folder, keys, name, texts=None):
+    # Append keys to the folder's partition files, {partition}.{name}, and their ID texts to
+    # {partition}.{name}.values in the same order
+    parts = partition_of(keys)
+    order = np.argsort(parts, kind='stable')
+    keys = keys[order]
+    texts = texts[order] if texts is not None else None
+    bounds = np.searchsorted(parts[order], np.arange(PARTITIONS + 1))
+    for part in range(PARTITIONS):
+        if bounds[part] < bounds[part + 1]:
+            path = os.path.join(folder, f"{part:03d}.{name}")
+            with open(path, 'ab') as f:
+                keys[bounds[part]:bounds[part + 1]].tofile(f)
+            if texts is not None:
+                with open(path + '.values', 'ab') as f:
+                    f.write(''.join(text + SEPARATOR for text in texts[bounds[part]:bounds[part + 1]]).encode('utf-8'))
+
+
+def read_texts(path, rows):
+    # ID texts of the given rows of a .values file
+    data = open(path, 'rb').read()
+    ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 0)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    return [data[starts[row]:ends[row]].decode('utf-8') for row in rows]
+
+
+def rehash(folder, names):
+    # Once some keys of a table had to be hashed, integer keys spilled before (or by another byte
+    # range) are hashed too, or 1 and '1' would never meet. Their partitions change, so they are
+    # written again, one file at a time.
+    for name in names:
+        path = os.path.join(folder, name)
+        texts = as_text(np.fromfile(path, dtype=np.int64))
+        os.remove(path)
+        write_partitions(folder, hash_keys(texts), f"{name[4:]}.int.hashed", texts)
+
+
+def duplicates_in(keys):
+    # Rows repeating an earlier key, and the repeated keys (sorted)
+    uniques, counts = np.unique(keys, return_counts=True)
+    repeated = counts > 1
+    return int(counts[repeated].sum() - np.count_nonzero(repeated)), uniques[repeated]
+
+
+def first_texts(found, keys, repeated, texts_of):
+    # Add the ID text of the first row of each repeated hash to `found`, texts_of(rows) gives the
+    # texts of rows of `keys`
+    rows = np.flatnonzero(np.isin(keys, repeated))
+    for key, text in zip(keys[rows].tolist(), texts_of(rows)):
+        found.setdefault(key, text)
+
+
+def merge(folder, sample_size=SAMPLE_SIZE):
+    # Count the duplicates in a folder of partition files, one partition in memory at a time, then
+    # remove the folder. Hashed keys are sampled by the IDs spilled next to them.
+    names = [name for name in os.listdir(folder) if not name.endswith('.values')]
+    hashed = any(name.endswith('.hashed') for name in names)
+    if hashed:
+        rehash(folder, [name for name in names if not name.endswith('.hashed')])
+        names = [name for name in os.listdir(folder) if not name.endswith('.values')]
+    total, sample = 0, []
+    for part in range(PARTITIONS):
+        prefix = f"{part:03d}."
+        files = [name for name in names if name.startswith(prefix)]
+        keys = [np.fromfile(os.path.join(folder, name), dtype=np.int64) for name in files]
+        if not keys:
+            continue
+        count, repeated = duplicates_in(np.concatenate(keys))
+        total += count
+        repeated = repeated[:sample_size]
+        if not hashed:
+            sample.extend(repeated.tolist())
+        elif len(repeated):
+            found = {}
+            for name, file_keys in zip(files, keys):
+                path = os.path.join(folder, name + '.values')
+                first_texts(found, file_keys, repeated, lambda rows: read_texts(path, rows))
+            sample.extend(found.values())
+    discard(folder)
+    return total, sorted(sample)[:sample_size]
+
+
+def discard(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+class DuplicateKeys:
+    # ID keys of one table, checked for repeats once every chunk is in. Keys stay in memory up to
+    # memory_limit bytes and are hash-partitioned into files past that; equal keys always land in
+    # the same partition, so each is checked on its own. Workers counting byte ranges of one file
+    # pass a shared folder and always spill into it, under their own name. Hashed keys keep their
+    # ID texts alongside, so the sample shows real IDs.
+    def __init__(self, folder=None, name='keys', memory_limit=MEMORY_LIMIT, spill_dir=None):
+        self.folder = folder
+        self.name = name
+        self.memory_limit = memory_limit if folder is None else 0
+        self.spill_dir = spill_dir
+        self.buffered = []
+        self.texts = []
+        self.size = 0
+        self.hashed = False
+
+    def add(self, values):
+        # Every key of a table is hashed once any of its IDs isn't an integer. Keys already
+        # spilled are hashed by merge.
+        keys, texts = int64_keys(values)
+        if texts is not None and not self.hashed:
+            self.texts = [as_text(buffered) for buffered in self.buffered]
+            self.buffered = [hash_keys(buffered) for buffered in self.texts]
+            self.size += sum(len(buffered) for buffered in self.texts) * TEXT_SIZE
+            self.hashed = True
+        elif self.hashed and texts is None:
+            texts = as_text(keys)
+            keys = hash_keys(texts)
+        self.buffered.append(keys)
+        self.size += keys.nbytes
+        if self.hashed:
+            self.texts.append(texts)
+            self.size += len(texts) * TEXT_SIZE
+        if self.size > self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        if self.folder is None:
+            self.folder = tempfile.mkdtemp(prefix='dump-keys-', dir=self.spill_dir)
+        if not self.buffered:
+            return
+        keys = np.concatenate(self.buffered)
+        if self.hashed:
+            write_partitions(self.folder, keys, f"{self.name}.hashed", np.concatenate(self.texts))
+        else:
+            write_partitions(self.folder, keys, self.name)
+        self.buffered, self.texts, self.size = [], [], 0
+
+    def finish(self, sample_size=SAMPLE_SIZE):
+        # (duplicate rows, sample of repeated IDs)
+        if self.folder is None:
+            keys = np.concatenate(self.buffered) if self.buffered else np.empty(0, dtype=np.int64)
+            count, repeated = duplicates_in(keys)
+            repeated = repeated[:sample_size]
+            if not self.hashed:
+                return count, repeated.tolist()
+            found, texts = {}, np.concatenate(self.texts)
+            first_texts(found, keys, repeated, lambda rows: texts[rows])
+            return count, sorted(found.values())
+        self.spill()
+        return merge(self.folder, sample_size)
+
+    def discard(self):
+        # Drop the keys without counting them, when the table failed part way
+        self.buffered, self.texts, self.size = [], [], 0
+        if self.folder is not None:
+            discard(self.folder)
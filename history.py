@@ -0,0 +1,60 @@
+import json
+import os
+import statistics
+import time
+
+# Throughput assumed before any table has been timed
+DEFAULT_BYTES_PER_SECOND = 50 * 1024 * 1024
+
+
+class RunHistory:
+    # Duration and throughput of the last few runs of every table, keyed database/mode/table_name,
+    # used to predict how long each task of the next run takes
+    def __init__(self, path, keep=10):
+        self.path = path
+        self.keep = keep
+        self.tables = {}
+        self.overall = None
+        self.changed = False
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.tables = json.load(f)
+
+    def key(self, task):
+        return f"{task['database']}/{task['mode']}/{task['table_name']}"
+
+    def record(self, task, seconds):
+        if not self.path or not task['raw_path']:
+            return
+        runs = self.tables.setdefault(self.key(task), [])
+        runs.append({'seconds': round(seconds, 3), 'bytes': int(task['raw_size']),
+                     'rows': int(task['row_count'] or 0), 'when': int(time.time())})
+        del runs[:-self.keep]
+        self.overall = None
+        self.changed = True
+
+    def throughput(self, runs):
+        speeds = [run['bytes'] / run['seconds'] for run in runs if run['seconds'] > 0 and run['bytes'] > 0]
+        return statistics.median(speeds) if speeds else None
+
+    def predict(self, task):
+        # Seconds for this task: its own recent throughput scaled to today's file size, or the
+        # throughput of every table seen so far for tables without history
+        if not task['raw_path']:
+            return 0.0
+        runs = self.tables.get(self.key(task), [])
+        speed = self.throughput(runs)
+        if speed is None and runs:
+            return statistics.median(run['seconds'] for run in runs)
+        if speed is None:
+            if self.overall is None:
+                self.overall = self.throughput([run for runs in self.tables.values() for run in runs]) or 0
+            speed = self.overall
+        return task['raw_size'] / (speed or DEFAULT_BYTES_PER_SECOND)
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        with open(self.path, 'w') as f:
+            json.dump(self.tables, f, indent=2, sort_keys=True)
+        self.changed = False
@@ -0,0 +1,502 @@
+import csv
+import gzip
+import io
+import mmap
+import os
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Dumps may be exported plain or compressed, tried in this order
+COMPRESSIONS = {'': None, '.gz': 'gzip', '.zst': 'zstd'}
+
+
+# Declared schema types (see schema.py) as each backend spells them. Timestamps stay strings
+# in pandas and go through dates.DateParser.
+PANDAS_TYPES = {'int8': 'int8', 'int64': 'int64', 'float64': 'float64', 'bool': 'bool',
+                'string': str, 'timestamp': str, 'timestamp_tz': str}
+
+
+def arrow_types(dtypes):
+    types = {'int8': pa.int8(), 'int64': pa.int64(), 'float64': pa.float64(), 'bool': pa.bool_(),
+             'string': pa.string(), 'timestamp': pa.timestamp('ns'), 'timestamp_tz': pa.timestamp('ns', tz='UTC')}
+    return {col: types[dtype] for col, dtype in (dtypes or {}).items()}
+
+
+class PandasReader:
+    name = 'pandas'
+
+    def read(self, source, dtypes=None, usecols=None, out=None):
+        return pd.read_csv(self.input(source), dtype=self.dtype(dtypes), usecols=usecols)
+
+    def iter_chunks(self, source, chunksize, dtypes=None, usecols=None, out=None):
+        return pd.read_csv(self.input(source), chunksize=chunksize, dtype=self.dtype(dtypes), usecols=usecols)
+
+    def input(self, source):
+        return source.stream() if isinstance(source, DumpSource) else source
+
+    def dtype(self, dtypes):
+        if not dtypes:
+            return None
+        return {col: PANDAS_TYPES[dtype] for col, dtype in dtypes.items()}
+
+
+class ArrowReader:
+    name = 'pyarrow'
+
+    def __init__(self):
+        # Parse blocks on all cores
+        self.read_options = pa_csv.ReadOptions(use_threads=True)
+        self.fallback = PandasReader()
+
+    def input(self, source):
+        return source.arrow_input() if isinstance(source, DumpSource) else source
+
+    def convert_options(self, dtypes, usecols):
+        # Empty strings become NaN like they do in pandas
+        return pa_csv.ConvertOptions(strings_can_be_null=True, column_types=arrow_types(dtypes),
+                                     include_columns=usecols)
+
+    # Notes go to `out` (stdout if None), so callers can keep them with the table they belong to
+    def read(self, source, dtypes=None, usecols=None, out=None):
+        try:
+            table = pa_csv.read_csv(self.input(source), read_options=self.read_options,
+                                    convert_options=self.convert_options(dtypes, usecols))
+        except pa.ArrowInvalid as e:
+            print(f"pyarrow could not parse {source}, falling back to pandas: {str(e)}", file=out)
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            return self.fallback.read(source, dtypes, usecols)
+        return table.to_pandas()
+
+    def iter_chunks(self, source, chunksize, dtypes=None, usecols=None, out=None):
+        try:
+            reader = pa_csv.open_csv(self.input(source), read_options=self.read_options,
+                                     convert_options=self.convert_options(dtypes, usecols))
+        except pa.ArrowInvalid as e:
+            print(f"pyarrow could not parse {source}, falling back to pandas: {str(e)}", file=out)
+            yield from self.fallback.iter_chunks(source, chunksize, dtypes, usecols)
+            return
+
+        # pyarrow streams small record batches, regroup them into chunks of about chunksize rows.
+        # Column types are inferred from the first block only, so a column that changes type
+        # further down fails mid-stream; pandas then carries on after the rows already handed out.
+        batches, rows, emitted, done = [], 0, False, 0
+        try:
+            for batch in reader:
+                batches.append(batch)
+                rows += batch.num_rows
+                if rows >= chunksize:
+                    yield pa.Table.from_batches(batches).to_pandas()
+                    batches, rows, emitted, done = [], 0, True, done + rows
+        except pa.ArrowInvalid as e:
+            print(f"pyarrow could not parse {source} past row {done}, falling back to pandas: {str(e)}", file=out)
+            yield from skip_rows(self.fallback.iter_chunks(source, chunksize, dtypes, usecols), done)
+            return
+        if batches or not emitted:
+            yield pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
+
+def compression_of(path):
+    for suffix, compression in COMPRESSIONS.items():
+        if suffix and path.endswith(suffix):
+            return compression
+    return None
+
+
+def open_decompressed(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if zstandard is None:
+        raise ImportError(f"zstandard is required to read {path}")
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+
+
+class DecompressingStream:
+    # File-like stream that decompresses on a background thread into a bounded queue, so
+    # decompression overlaps with parsing and nothing gets expanded to disk
+    def __init__(self, path, compression, block_size=1024 * 1024, depth=8):
+        self.queue = queue.Queue(depth)
+        self.pending = b''
+        self.done = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.fill, args=(path, compression, block_size), daemon=True)
+        self.thread.start()
+
+    def fill(self, path, compression, block_size):
+        try:
+            with open_decompressed(path, compression) as f:
+                while not self.stopped.is_set():
+                    block = f.read(block_size)
+                    self.put(block)
+                    if not block:
+                        return
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        parts, length = [self.pending], len(self.pending)
+        while not self.done and (size < 0 or length < size):
+            block = self.queue.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.done = True
+                break
+            parts.append(block)
+            length += len(block)
+        data = b''.join(parts)
+        if size < 0:
+            size = len(data)
+        self.pending = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.stopped.set()
+
+
+class DumpSource:
+    # One raw file, memory mapped once and shared by the record counter, the edge reader and
+    # the parser so the file only goes through the page cache, not through several buffers.
+    # Compressed dumps can't be mapped and are decompressed as a stream instead.
+    def __init__(self, path):
+        self.path = path
+        self.compression = compression_of(path)
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.streams = []
+        if self.compression:
+            self.buffer = None
+        else:
+            # Empty files can't be mapped
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+
+    def __str__(self):
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stream(self):
+        # File-like view over the mapping, pandas reads it block by block
+        if self.compression:
+            self.streams.append(DecompressingStream(self.path, self.compression))
+            return self.streams[-1]
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.seek(0)
+            return self.buffer
+        return io.BytesIO(self.buffer)
+
+    def arrow_input(self):
+        # pyarrow parses straight out of the mapping without a copy, compressed files are
+        # decompressed by pyarrow's own readahead
+        if self.compression:
+            return pa.CompressedInputStream(self.path, self.compression)
+        return pa.BufferReader(self.buffer)
+
+    def blocks(self, block_size=64 * 1024):
+        if not self.compression:
+            for start in range(0, self.size, block_size):
+                yield self.buffer[start:start + block_size]
+            return
+        with open_decompressed(self.path, self.compression) as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                yield block
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+        if isinstance(self.buffer, mmap.mmap):
+            try:
+                self.buffer.close()
+            except BufferError:
+                # A parser abandoned mid-stream still holds a view, the map goes when it does
+                pass
+        self.file.close()
+
+
+class RangeSource(DumpSource):
+    # The header and the records in [start, end) of an uncompressed dump, read into memory and
+    # parsed like a file of their own
+    def __init__(self, path, header_end, start, end):
+        self.path = f"{path} [{start}:{end}]"
+        self.compression = None
+        self.streams = []
+        with open(path, 'rb') as f:
+            header = f.read(header_end)
+            f.seek(start)
+            self.buffer = header + f.read(end - start)
+        self.size = len(self.buffer)
+
+    def close(self):
+        self.buffer = b''
+
+
+def skip_rows(chunks, count):
+    # Chunks without their first `count` rows
+    for chunk in chunks:
+        if count >= len(chunk):
+            count -= len(chunk)
+            continue
+        yield chunk.iloc[count:]
+        count = 0
+
+
+def read_ahead(path, stop=None, limit=None, block_size=8 * 1024 * 1024):
+    # Read a file through once so it sits in the OS page cache before it is parsed. The bytes are
+    # read into one reused buffer and dropped, so only the page cache grows. Only the first
+    # `limit` bytes of a bigger file are read, the rest would push them out of the cache again.
+    buf = bytearray(block_size)
+    left = float('inf') if limit is None else limit
+    with open(path, 'rb', buffering=0) as f:
+        while left > 0 and not (stop and stop.is_set()):
+            read = f.readinto(buf)
+            if not read:
+                break
+            left -= read
+
+
+def odd_quote_runs(view, start, end):
+    # Runs of an odd number of quotes in view[start:end] as (first quote, whether the run starts a
+    # field). Even runs are escaped quotes or an empty quoted field and never change whether a
+    # newline ends a record.
+    quotes = np.flatnonzero(view[start:end] == 34) + start
+    heads = np.flatnonzero(np.diff(quotes, prepend=-2) != 1)
+    lengths = np.diff(heads, append=len(quotes))
+    first = quotes[heads[lengths % 2 == 1]]
+    before = view[np.maximum(first - 1, 0)]
+    return first, (first == 0) | (before == 44) | (before == 10)
+
+
+def quote_state(data, start, end, inside=False, block_size=64 * 1024 * 1024):
+    # Whether data[start:end] ends inside a quoted field, given the state it starts in. Like the
+    # parsers, a quote opens a field only at its start (after a comma, a newline or at the start
+    # of the data), so the 27" in `1,27" monitor,1` is just a character; inside a field every odd
+    # run of quotes closes it.
+    view = np.frombuffer(data, dtype=np.uint8)
+    pos = start
+    while pos < end:
+        stop = min(pos + block_size, end)
+        while stop < end and view[stop - 1] == 34:
+            # A run of quotes stays in one block
+            stop += 1
+        runs, opens = odd_quote_runs(view, pos, stop)
+        # Every run toggles the state unless one that doesn't start a field comes outside a
+        # quoted field, only then do the runs have to be walked one by one
+        outside = (np.arange(len(runs)) % 2 == 1) == inside
+        if np.any(outside & ~opens):
+            for opening in opens.tolist():
+                inside = not inside if inside else opening
+        else:
+            inside ^= bool(len(runs) % 2)
+        pos = stop
+    return inside
+
+
+def head_records(blocks, count):
+    # Read forward until `count` records are complete, newlines inside quotes don't end a record
+    data, ends, scanned, inside = b'', [], 0, False
+    blocks = iter(blocks)
+    while len(ends) < count:
+        nl = data.find(b'\n', scanned)
+        if nl == -1:
+            block = next(blocks, b'')
+            if not block:
+                if data[scanned:].strip():
+                    ends.append(len(data))
+                break
+            data += block
+            continue
+        inside = quote_state(data, scanned, nl, inside)
+        record = data[ends[-1] if ends else 0:nl + 1]
+        scanned = nl + 1
+        if not inside and record.strip():
+            ends.append(scanned)
+    return data, ends
+
+
+def split_records(source, size):
+    # Header end and byte ranges of about `size` bytes covering the records of an uncompressed
+    # dump. Every range starts on a record boundary, outside any quoted field; it ends at the
+    # first newline past its cut that is outside one too, see quote_state.
+    data, ends = head_records(source.blocks(), 1)
+    if not ends:
+        return 0, []
+    buf, header_end = source.buffer, ends[0]
+    ranges, start = [], header_end
+    while start < source.size:
+        end = source.size
+        if start + size < source.size:
+            pos, inside = start, False
+            nl = buf.find(b'\n', start + size)
+            while nl != -1:
+                inside = quote_state(buf, pos, nl, inside)
+                if not inside:
+                    end = nl + 1
+                    break
+                pos = nl + 1
+                nl = buf.find(b'\n', pos)
+        ranges.append((start, end))
+        start = end
+    # A file without records still gets a range, so its header is checked
+    return header_end, ranges or [(header_end, source.size)]
+
+
+def read_header(source):
+    # Column names from the first record only
+    data, ends = head_records(source.blocks(), 1)
+    if not ends:
+        return []
+    return next(csv.reader([data[:ends[0]].decode('utf-8-sig').rstrip('\r\n')]))
+
+
+def newline_states(view, newlines, inside):
+    # Whether each of the newlines is inside a quoted field, walking the data from its start in
+    # the given state (see quote_state)
+    runs, opens = odd_quote_runs(view, 0, len(view))
+    states = np.empty(len(runs) + 1, dtype=bool)
+    states[0] = inside
+    for i, opening in enumerate(opens.tolist()):
+        inside = not inside if inside else opening
+        states[i + 1] = inside
+    return states[np.searchsorted(runs, newlines)]
+
+
+def tail_record(buf, floor, block_size=64 * 1024):
+    # Walk backwards from the end of the buffer to the start of the last complete record, after the
+    # right-most newline outside a quoted field. Only at floor is the quote state known, so a
+    # window further in is walked from its start both ways, as if it began outside a quoted field
+    # and inside one. Once the two agree they stay equal and are right; until then the window
+    # grows. A window without quotes is taken as it is, every newline in it ends a record.
+    tail, pos = b'', len(buf)
+    while pos > floor:
+        start = max(floor, pos - block_size)
+        tail = buf[start:pos] + tail
+        pos = start
+
+        body = tail.rstrip(b'\r\n')
+        view = np.frombuffer(body, dtype=np.uint8)
+        newlines = np.flatnonzero(view == 10)
+        inside = newline_states(view, newlines, False)
+        if pos > floor and b'"' in body:
+            settled = np.logical_or.accumulate(inside == newline_states(view, newlines, True))
+            inside |= ~settled
+        ends = newlines[~inside]
+        if len(ends):
+            end = int(ends[-1]) + 1
+            return pos + end, body[end:]
+    return floor, tail.rstrip(b'\r\n')
+
+
+def stream_tail(blocks, keep=4 * 1024 * 1024):
+    # Last bytes of a stream that can't seek and the offset they start at
+    window, offset = b'', 0
+    for block in blocks:
+        window += block
+        if len(window) > 2 * keep:
+            offset += len(window) - keep
+            window = window[-keep:]
+    return offset, window
+
+
+def read_edge_rows(source, reader, dtypes=None):
+    # Header, first and last data rows of a CSV for compare_validation_files, a few KB of I/O
+    # no matter how large the file is (compressed dumps have to be streamed through once)
+    data, ends = head_records(source.blocks(), 2)
+    if len(ends) < 2:
+        return reader.read(io.BytesIO(data), dtypes)
+
+    header, first = data[:ends[0]], data[ends[0]:ends[1]]
+    if source.buffer is not None:
+        last_start, last = tail_record(source.buffer, ends[0])
+    else:
+        offset, window = stream_tail(source.blocks(1024 * 1024))
+        last_start, last = tail_record(window, max(0, ends[0] - offset))
+        last_start += offset
+    if last_start < ends[1]:
+        return reader.read(io.BytesIO(header + first), dtypes)
+    return reader.read(io.BytesIO(header + first.rstrip(b'\r\n') + b'\n' + last + b'\n'), dtypes)
+
+
+def count_block(block, quoted, inside):
+    # Newlines outside quotes in one block, given the quote state it starts in
+    newlines = block == 10
+    if quoted:
+        # Quote parity at every byte, carried over from the previous block
+        in_quotes = np.bitwise_xor.accumulate(block == 34) ^ inside
+        newlines &= ~in_quotes
+        inside = bool(in_quotes[-1])
+    return int(np.count_nonzero(newlines)), inside
+
+
+def count_buffer(buf, block_size=64 * 1024 * 1024):
+    # Data records in a CSV buffer: newlines outside quotes once trailing blank lines are dropped,
+    # which also leaves out the header line. Quotes are taken by parity and blank lines in the
+    # middle count, so precheck_row_count confirms a mismatch by parsing.
+    end = len(buf)
+    while end > 0 and buf[end - 1] in b'\r\n':
+        end -= 1
+    if end == 0:
+        return 0
+
+    quoted = buf.find(b'"', 0, end) != -1
+    total, inside = 0, False
+    for start in range(0, end, block_size):
+        block = np.frombuffer(buf, dtype=np.uint8, count=min(block_size, end - start), offset=start)
+        count, inside = count_block(block, quoted, inside)
+        total += count
+    return total
+
+
+def count_stream(blocks):
+    # Same count as count_buffer for a stream that can only be read once, the newlines of the
+    # trailing blank lines are tracked as they come and taken off at the end
+    total, inside, trailing = 0, False, 0
+    for block in blocks:
+        count, inside = count_block(np.frombuffer(block, dtype=np.uint8), True, inside)
+        total += count
+        body = block.rstrip(b'\r\n')
+        run = block.count(b'\n', len(body))
+        trailing = trailing + run if not body else run
+    return total - trailing
+
+
+def count_records(source):
+    # Count records straight off the mapping, at disk speed and without any pandas parsing
+    if source.buffer is None:
+        return count_stream(source.blocks(16 * 1024 * 1024))
+    return count_buffer(source.buffer)
+
+
+READERS = {'pandas': PandasReader, 'pyarrow': ArrowReader}
+
+
+def get_reader(name='pandas'):
+    if name == 'pyarrow' and pa_csv is None:
+        print("pyarrow is not installed, falling back to the pandas reader")
+        name = 'pandas'
+    return READERS[name]()
@@ -0,0 +1,152 @@
+import operator
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+# Row predicates are nested tuples: (op, column, value) compares a column to a literal or to a
+# named bound ('window_start', 'window_end'), ('&', a, b), ('|', a, b) and ('~', a) combine them.
+# Equal subexpressions are equal tuples, so a plan evaluates each of them once per frame.
+COMPARISONS = {'>=': operator.ge, '>': operator.gt, '<': operator.lt, '<=': operator.le,
+               '==': operator.eq, '!=': operator.ne}
+NAT = np.iinfo(np.int64).min
+
+CREATED_SINCE_START = ('>=', 'DateCreated', 'window_start')
+MODIFIED_SINCE_START = ('>=', 'DateModified', 'window_start')
+CREATED_IN_WINDOW = ('&', CREATED_SINCE_START, ('<', 'DateCreated', 'window_end'))
+MODIFIED_IN_WINDOW = ('&', MODIFIED_SINCE_START, ('<', 'DateModified', 'window_end'))
+
+
+def columns_of(expr):
+    if expr[0] in COMPARISONS:
+        return {expr[1]}
+    return set().union(*(columns_of(arg) for arg in expr[1:]))
+
+
+def compare(op, series, value):
+    # Tz-aware columns against a timestamp are compared as int64 epoch ticks in the column's unit.
+    # NaT is the smallest int64, so only '<' and '<=' need it masked out to match pandas.
+    if isinstance(value, pd.Timestamp) and isinstance(series.dtype, pd.DatetimeTZDtype):
+        ticks = series.array.asi8
+        result = COMPARISONS[op](ticks, value.as_unit(series.dtype.unit).asm8.view('int64'))
+        if op in ('<', '<='):
+            result &= ticks != NAT
+        return result
+    # Anything else goes through pandas, which raises on naive or unparsed dates as before
+    return COMPARISONS[op](series, value).to_numpy()
+
+
+def evaluate(expr, df, bounds, memo):
+    if expr in memo:
+        return memo[expr]
+    op = expr[0]
+    if op == '&':
+        value = evaluate(expr[1], df, bounds, memo) & evaluate(expr[2], df, bounds, memo)
+    elif op == '|':
+        value = evaluate(expr[1], df, bounds, memo) | evaluate(expr[2], df, bounds, memo)
+    elif op == '~':
+        value = ~evaluate(expr[1], df, bounds, memo)
+    else:
+        bound = bounds[expr[2]] if isinstance(expr[2], str) else expr[2]
+        value = compare(op, df[expr[1]], bound)
+    memo[expr] = value
+    return value
+
+
+@dataclass(frozen=True)
+class Rule:
+    # kind 'rows': the row count must match the manifest row_count. 'present': one of `columns` must
+    # exist, the first one found is reported. 'count': no row may match `violation`, checked only
+    # when every column it reads exists. 'unique': the first of `columns` found must not repeat a
+    # value; its keys go to a duplicates.DuplicateKeys across chunks and are counted at the end.
+    name: str
+    kind: str
+    message: str
+    violation: tuple = None
+    columns: tuple = ()
+
+    def reads(self):
+        return columns_of(self.violation) if self.violation else set(self.columns)
+
+    def applies(self, columns):
+        return self.kind != 'count' or self.reads() <= set(columns)
+
+    def check(self, counts, expected):
+        if self.kind == 'rows':
+            failed = counts['rows'] != expected
+        elif self.kind == 'present':
+            failed = counts.get(self.name) is None
+        else:
+            failed = bool(counts.get(self.name))
+        if not failed:
+            return None
+        return self.message.format(count=counts.get(self.name), expected=expected,
+                                   sample=counts.get(f"{self.name}_sample", ''))
+
+
+class RuleSet:
+    # The rules of one etl mode, compiled once per table schema into the list of rules that apply
+    # to it. Counting a frame evaluates every predicate of that list in one pass over shared
+    # boolean arrays; chunks of the same file reuse the compiled plan.
+    def __init__(self, rules):
+        self.rules = rules
+        self.plans = {}
+        # Every column some rule reads, for the column projection
+        self.columns = sorted(set().union(*(rule.reads() for rule in rules)))
+
+    def plan(self, columns):
+        key = tuple(columns)
+        if key not in self.plans:
+            self.plans[key] = [rule for rule in self.rules if rule.applies(columns)]
+        return self.plans[key]
+
+    def count(self, df, bounds, keys=None):
+        counts = {'rows': len(df)}
+        memo = {}
+        for rule in self.plan(df.columns):
+            if rule.kind == 'present':
+                counts[rule.name] = next((col for col in rule.columns if col in df.columns), None)
+            elif rule.kind == 'unique':
+                column = next((col for col in rule.columns if col in df.columns), None)
+                if keys is not None and column is not None:
+                    keys.add(df[column])
+            elif rule.kind == 'count':
+                counts[rule.name] = int(np.count_nonzero(evaluate(rule.violation, df, bounds, memo)))
+        return counts
+
+    def messages(self, counts, expected):
+        # Messages in rule order, rules that didn't apply to the table have no count and pass
+        messages = [rule.check(counts, expected) for rule in self.rules]
+        return [message for message in messages if message]
+
+
+def id_rule(id_columns):
+    return Rule('id_col', 'present', "No valid ID column found", columns=tuple(id_columns))
+
+
+def unique_rule(id_columns):
+    return Rule('duplicate_ids', 'unique', "Found {count} duplicate IDs{sample}", columns=tuple(id_columns))
+
+
+def daily_rules(id_columns):
+    return [
+        Rule('rows', 'rows', "Row count mismatch: expected {expected}, got {count}"),
+        id_rule(id_columns),
+        unique_rule(id_columns),
+        Rule('invalid_created', 'count', "Found {count} invalid IsCreated values",
+             ('&', CREATED_SINCE_START, ('!=', 'IsCreated', 1))),
+        Rule('invalid_modified', 'count', "Found {count} invalid IsModified values",
+             ('&', MODIFIED_SINCE_START, ('!=', 'IsModified', 1))),
+        Rule('invalid_dates', 'count', "Found {count} records outside time window",
+             ('~', ('|', CREATED_IN_WINDOW, MODIFIED_IN_WINDOW))),
+    ]
+
+
+def full_rules(id_columns):
+    return [
+        Rule('rows', 'rows', "Row count mismatch: expected {expected}, got {count}"),
+        id_rule(id_columns),
+        unique_rule(id_columns),
+        Rule('invalid_created', 'count', "Found {count} rows with IsCreated != 1", ('!=', 'IsCreated', 1)),
+        Rule('invalid_modified', 'count', "Found {count} rows with IsModified != 0", ('!=', 'IsModified', 0)),
+    ]
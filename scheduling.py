@@ -0,0 +1,62 @@
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Cost of a table task for each scheduling policy, bigger runs earlier. row_count is None when
+# the manifest has none for the table.
+COSTS = {
+    'size': lambda task: (task['raw_size'], task['row_count'] or 0),
+    'rows': lambda task: (task['row_count'] or 0, task['raw_size']),
+}
+
+
+def submission_order(tasks, policy='size', history=None):
+    # Longest first (LPT), so one huge table is never started last and left running alone
+    # while the other workers sit idle. 'history' uses the durations predicted from earlier
+    # runs, 'manifest' keeps the manifest order.
+    if policy == 'history' and history is not None:
+        cost = history.predict
+    elif policy in COSTS:
+        cost = COSTS[policy]
+    else:
+        return list(range(len(tasks)))
+    return sorted(range(len(tasks)), key=lambda i: cost(tasks[i]), reverse=True)
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class Progress:
+    # Live ETA on stderr: predicted cost of the tables still running or queued, corrected by how
+    # far off the predictions have been so far in this run, spread over the workers. Printed at
+    # most every `interval` seconds.
+    def __init__(self, tasks, history, workers, interval=10):
+        self.predicted = [history.predict(task) for task in tasks]
+        self.remaining = set(range(len(tasks)))
+        self.workers = workers
+        self.interval = interval
+        self.actual = 0.0
+        self.expected = 0.0
+        self.shown = time.monotonic()
+        if tasks:
+            self.show("predicted")
+
+    def done(self, i, seconds):
+        self.remaining.discard(i)
+        self.actual += seconds
+        self.expected += self.predicted[i]
+        if self.remaining and time.monotonic() - self.shown < self.interval:
+            return
+        self.show(f"{len(self.predicted) - len(self.remaining)}/{len(self.predicted)} tables done")
+
+    def show(self, status):
+        ratio = self.actual / self.expected if self.expected > 0 else 1.0
+        left = [self.predicted[i] * ratio for i in self.remaining]
+        slots = min(self.workers, len(left)) or 1
+        seconds_left = max(sum(left) / slots, max(left, default=0))
+        finish = datetime.now() + timedelta(seconds=seconds_left)
+        print(f"[{status}, ~{format_seconds(seconds_left)} left, ETA {finish:%H:%M:%S}]", file=sys.stderr, flush=True)
+        self.shown = time.monotonic()
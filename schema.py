@@ -0,0 +1,103 @@
+import json
+import os
+
+import pandas as pd
+
+FLAG_COLUMNS = ['IsCreated', 'IsModified']
+NUMERIC_TYPES = ['int8', 'int64', 'float64']
+
+
+def column_type(col, values, date_parser):
+    # Declared type of one parsed column, flags that only hold 0/1 are narrowed to int8
+    if pd.api.types.is_datetime64_any_dtype(values):
+        fmt = date_parser.formats.get(col)
+        if fmt is None or fmt == 'ISO8601':
+            return None
+        return 'timestamp_tz' if '%z' in fmt else 'timestamp'
+    if pd.api.types.is_bool_dtype(values):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(values):
+        if col in FLAG_COLUMNS and values.isin([0, 1]).all():
+            return 'int8'
+        return 'int64'
+    if pd.api.types.is_float_dtype(values):
+        return 'float64'
+    return 'string'
+
+
+def widen(a, b):
+    if a == b:
+        return a
+    if a is None or b is None:
+        return None
+    if a in NUMERIC_TYPES and b in NUMERIC_TYPES:
+        return NUMERIC_TYPES[max(NUMERIC_TYPES.index(a), NUMERIC_TYPES.index(b))]
+    return 'string'
+
+
+class SchemaRegistry:
+    # Declared column types per database/table_name, kept in a JSON file that can be edited by hand.
+    # Columns without an entry are learned from the parsed data and saved once the table passes
+    # validation, so tables read with a column projection get completed on later runs.
+    def __init__(self, path):
+        self.path = path
+        self.schemas = {}
+        self.pending = {}
+        # Entries committed or forgotten since the last drain(), handed back from worker processes
+        self.updates = {}
+        self.changed = False
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.schemas = json.load(f)
+
+    def key(self, database, table_name):
+        return f"{database}/{table_name}"
+
+    def get(self, database, table_name):
+        return self.schemas.get(self.key(database, table_name))
+
+    def observe(self, database, table_name, df, date_parser):
+        key = self.key(database, table_name)
+        known = self.schemas.get(key, {})
+        columns = [col for col in df.columns if col not in known]
+        if not self.path or not columns or df.empty:
+            return
+
+        seen = self.pending.setdefault(key, {})
+        for col in columns:
+            dtype = column_type(col, df[col], date_parser)
+            seen[col] = widen(seen[col], dtype) if col in seen else dtype
+
+    def commit(self, database, table_name):
+        learned = self.pending.pop(self.key(database, table_name), None)
+        learned = {col: dtype for col, dtype in (learned or {}).items() if dtype}
+        if learned:
+            self.schemas.setdefault(self.key(database, table_name), {}).update(learned)
+            self.updates[self.key(database, table_name)] = self.schemas[self.key(database, table_name)]
+            self.changed = True
+
+    def forget(self, database, table_name):
+        key = self.key(database, table_name)
+        self.pending.pop(key, None)
+        if self.schemas.pop(key, None) is not None:
+            self.updates[key] = None
+            self.changed = True
+
+    def drain(self):
+        updates, self.updates = self.updates, {}
+        return updates
+
+    def apply(self, updates):
+        for key, learned in updates.items():
+            if learned is None:
+                self.schemas.pop(key, None)
+            else:
+                self.schemas[key] = learned
+            self.changed = True
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        with open(self.path, 'w') as f:
+            json.dump(self.schemas, f, indent=2, sort_keys=True)
+        self.changed = False
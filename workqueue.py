@@ -0,0 +1,126 @@
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plan (
+    seq INTEGER PRIMARY KEY,
+    line TEXT,
+    task TEXT,
+    rank INTEGER,
+    state TEXT NOT NULL DEFAULT 'queued',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+)
+"""
+
+
+def encode(value):
+    # Tasks and results are stored as JSON, never pickled: whoever can write the share must not be
+    # able to run code on the workers. numpy scalars become plain numbers, timestamps ISO strings.
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} can't be stored in the work queue")
+
+
+def dumps(value):
+    return json.dumps(value, default=encode)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    # A run's plan kept in a SQLite file on shared storage. The coordinator enqueues it once, any
+    # number of workers on any host claim table tasks under a lease and store their results, and
+    # the coordinator prints the merged report in plan order. Validating a table only reads the
+    # dumps, so a task whose lease ran out (its worker crashed or lost the share) is simply claimed
+    # and run again by someone else; the first stored result wins.
+    def __init__(self, path, lease=900):
+        self.path = path
+        self.lease = lease
+        with self.connect() as db:
+            db.execute(SCHEMA)
+
+    def connect(self):
+        # A connection per call, never shared between threads or kept open while validating
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.execute("PRAGMA busy_timeout = 60000")
+        return contextlib.closing(db)
+
+    def enqueue(self, plan, ranks):
+        # Text lines are stored done so the report can be replayed in order. Returns False when
+        # the file already holds a plan, which is then resumed instead of queued twice.
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("SELECT COUNT(*) FROM plan").fetchone()[0]:
+                db.execute("COMMIT")
+                return False
+            tasks = iter(ranks)
+            db.executemany(
+                "INSERT INTO plan (seq, line, task, rank, state) VALUES (?, ?, ?, ?, ?)",
+                [(seq, None, dumps(item), next(tasks), 'queued') if isinstance(item, dict)
+                 else (seq, item, None, None, 'done') for seq, item in enumerate(plan)])
+            db.execute("COMMIT")
+        return True
+
+    def claim(self, owner):
+        # Next queued task, or one whose lease has expired, as (seq, task); None when there is nothing to take
+        now = time.time()
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT seq, task FROM plan WHERE state = 'queued' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY rank LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE plan SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 "
+                           "WHERE seq = ?", (owner, now + self.lease, row[0]))
+            db.execute("COMMIT")
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def renew(self, seq, owner):
+        with self.connect() as db:
+            db.execute("UPDATE plan SET lease_until = ? WHERE seq = ? AND owner = ? AND state = 'leased'",
+                       (time.time() + self.lease, seq, owner))
+
+    def heartbeat(self, seq, owner):
+        # Keeps renewing the lease from a background thread until the returned event is set
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease / 3):
+                self.renew(seq, owner)
+
+        threading.Thread(target=beat, daemon=True).start()
+        return stop
+
+    def complete(self, seq, result):
+        # result is a dict of plain values
+        with self.connect() as db:
+            db.execute("UPDATE plan SET state = 'done', result = ? WHERE seq = ? AND state != 'done'",
+                       (dumps(result), seq))
+
+    def planned(self):
+        # Whether the coordinator has enqueued its plan yet
+        with self.connect() as db:
+            return db.execute("SELECT COUNT(*) FROM plan").fetchone()[0] > 0
+
+    def pending(self):
+        with self.connect() as db:
+            return db.execute("SELECT COUNT(*) FROM plan WHERE state != 'done'").fetchone()[0]
+
+    def entries(self):
+        # (line, task, result) for the whole plan in order, result is None for text lines
+        with self.connect() as db:
+            rows = db.execute("SELECT line, task, result FROM plan ORDER BY seq").fetchall()
+        return [(line, task and json.loads(task), result and json.loads(result)) for line, task, result in rows]
+